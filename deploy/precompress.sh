@@ -0,0 +1,9 @@
+#!/bin/sh
+# Write .br and .gz copies next to each static text asset so nginx can serve them
+# with brotli_static/gzip_static instead of compressing on every request.
+set -e
+cd "$(dirname "$0")/../static"
+find . -type f \( -name '*.css' -o -name '*.js' -o -name '*.svg' \) | while read -r file; do
+    brotli -f -k -q 11 "$file"
+    gzip -f -k -9 "$file"
+done
@@ -0,0 +1,12 @@
+# Loaded automatically by gunicorn from the working directory (see Procfile)
+import os
+
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+
+# PaaS hosts like Heroku route outside traffic to $PORT, so listen publicly there.
+# Everywhere else nginx (deploy/nginx.conf) terminates TLS, so only listen on loopback.
+if "PORT" in os.environ:
+    bind = f"0.0.0.0:{os.environ['PORT']}"
+else:
+    bind = "127.0.0.1:5002"
@@ -1,16 +1,28 @@
-from datetime import date
-from flask import Flask, abort, render_template, redirect, url_for, flash, request
+from datetime import date, datetime
+from flask import Flask, abort, render_template, redirect, url_for, flash, request, make_response
 from flask_bootstrap import Bootstrap5
+from flask_caching import Cache
 from flask_ckeditor import CKEditor
-from flask_gravatar import Gravatar
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user, login_required
 from flask_sqlalchemy import SQLAlchemy
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.orm import relationship
+from werkzeug.http import is_resource_modified
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from gevent import get_hub, monkey
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship, selectinload, joinedload, defer
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from smtplib import SMTP
+from smtplib import SMTP, SMTPException
+from email.message import EmailMessage
+import hashlib
 import os
+import queue
+import sqlite3
+import threading
+import time
 
 
 # FLASK APP
@@ -19,21 +31,42 @@ app.config['SECRET_KEY'] = os.environ.get('FLASK_KEY')
 ckeditor = CKEditor(app)
 Bootstrap5(app)
 
+# CACHE
+# SimpleCache lives inside one process; with several gunicorn workers set REDIS_URL so they share entries
+app.config['CACHE_TYPE'] = os.environ.get('CACHE_TYPE', 'RedisCache' if os.environ.get('REDIS_URL') else 'SimpleCache')
+app.config['CACHE_REDIS_URL'] = os.environ.get('REDIS_URL')
+cache = Cache(app)
+
 # LOGIN MANAGER
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-  return User.query.get(user_id)
+  return db.session.get(User, int(user_id))
 
 
 
 # CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_URI', 'sqlite:///blog.db')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True, 'pool_recycle': 1800, 'query_cache_size': 1200}
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=10, max_overflow=20)
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith(('postgresql://', 'postgresql+psycopg2://')):
+    # Batch executemany UPDATE/DELETE as well; INSERTs already use insertmanyvalues
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['executemany_mode'] = 'values_plus_batch'
 db = SQLAlchemy()
 db.init_app(app)
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets readers keep going while a write is in progress
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 
 
 # DATABASE
@@ -42,18 +75,24 @@ class User(db.Model, UserMixin):
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(100), unique=True)
-    password = db.Column(db.String(100))
+    password = db.Column(db.String(250))
     name = db.Column(db.String(1000))
+    email_md5 = db.Column(db.String(32), index=True)
     
     posts = relationship("BlogPost", back_populates="author")
     
     comments = relationship("Comment", back_populates="comment_author")
 
+    def get_id(self):
+        # Keep the session's user id an int; load_user still coerces ids coming back from remember-me cookies
+        return self.id
+
 class Comment(db.Model):
     __tablename__ = "comment"
+    __table_args__ = (db.Index("ix_comment_post_id_id", "post_id", "id"),)
     
     id = db.Column(db.Integer, primary_key=True)
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     comment_author = relationship("User", back_populates="comments")
     post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
     parent_post = relationship("BlogPost", back_populates="comments")
@@ -63,23 +102,19 @@ class BlogPost(db.Model):
     __tablename__ = "blog_posts"
     id = db.Column(db.Integer, primary_key=True)
     
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     author = relationship("User", back_populates="posts")
     
     comments = relationship("Comment", back_populates="parent_post")
 
-with app.app_context():
-    db.create_all()
-
-
-
 # WRAPPER ADMIN ONLY
 def admin_only(function):
     @wraps(function)
@@ -90,16 +125,167 @@ def admin_only(function):
     return decorated_function
 
 
+# PASSWORD HASHING
+password_hasher = PasswordHasher(time_cost=2, memory_cost=7168, parallelism=1)
+
+def run_hash(function, *args):
+    # Hashing releases the GIL, so under gevent run it on a native thread and keep the other greenlets serving
+    if monkey.is_module_patched("threading"):
+        return get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+def argon2_matches(password_hash, password):
+    # Turn a mismatch into False inside the worker thread; gevent logs exceptions raised there
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def verify_password(user, password):
+    # Accounts created before Argon2 still hold Werkzeug PBKDF2 hashes, upgrade them on login
+    if not user.password.startswith("$argon2"):
+        if not run_hash(check_password_hash, user.password, password):
+            return False
+        user.password = run_hash(password_hasher.hash, password)
+        db.session.commit()
+        return True
+    if not run_hash(argon2_matches, user.password, password):
+        return False
+    if password_hasher.check_needs_rehash(user.password):
+        user.password = run_hash(password_hasher.hash, password)
+        db.session.commit()
+    return True
+
+
+# CONDITIONAL GET
+def conditional_response(version, render):
+    # Answer 304 without rendering when the client's copy is still current. ETag only: the version covers
+    # comments, the viewer and the CSRF window, none of which a Last-Modified date could follow
+    etag = hashlib.md5(version.encode()).hexdigest()
+    if request.method in ("GET", "HEAD") and not is_resource_modified(request.environ, etag=etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    # Pages differ per user, so make browsers revalidate instead of reusing them heuristically
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
 # GRAVATAR
+def email_hash(email):
+    return hashlib.md5(email.strip().lower().encode()).hexdigest()
+
+@app.template_global()
+def gravatar_url(user, size=100):
+    # Comments can outlive their author, and users may have no email; show the default avatar then
+    if user is None or not (user.email_md5 or user.email):
+        return f"https://www.gravatar.com/avatar/?s={size}&d=retro&f=y"
+    email_md5 = user.email_md5 or email_hash(user.email)
+    return f"https://www.gravatar.com/avatar/{email_md5}?s={size}&d=retro&r=g"
+
+
+# SCHEMA SYNC
+# create_all skips tables that already exist, so bring databases from older versions up to date
+def sync_schema():
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+    # Post dates used to be stored preformatted ("August 24, 2023"); convert them to real dates
+    date_column = next(column for column in inspector.get_columns("blog_posts") if column["name"] == "date")
+    if not isinstance(date_column["type"], db.Date):
+        with db.engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                connection.execute(db.text("ALTER TABLE blog_posts ALTER COLUMN date TYPE DATE USING to_date(date, 'Month DD, YYYY')"))
+            else:
+                # SQLite can't change the column type, but the Date type only needs ISO strings in it
+                rows = connection.execute(db.text("SELECT id, date FROM blog_posts WHERE date NOT LIKE '____-__-__'"))
+                for post_id, value in rows.all():
+                    post_date = datetime.strptime(value, "%B %d, %Y").date()
+                    connection.execute(
+                        db.text("UPDATE blog_posts SET date = :date WHERE id = :id"),
+                        {"date": post_date.isoformat(), "id": post_id},
+                    )
+
+    # Argon2 hashes outgrow the old VARCHAR(100) once the hasher parameters are raised;
+    # SQLite ignores VARCHAR lengths, so only Postgres needs the column widened
+    password_column = next(column for column in inspector.get_columns("users") if column["name"] == "password")
+    password_length = password_column["type"].length
+    if db.engine.dialect.name == "postgresql" and password_length is not None and password_length < User.password.type.length:
+        with db.engine.begin() as connection:
+            connection.execute(db.text(f"ALTER TABLE users ALTER COLUMN password TYPE VARCHAR({User.password.type.length})"))
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    for user in db.session.scalars(db.select(User).where(User.email_md5.is_(None), User.email.is_not(None))):
+        user.email_md5 = email_hash(user.email)
+    # The homepage and post ETags include updated_at, so posts that predate it need a value
+    db.session.execute(db.update(BlogPost).where(BlogPost.updated_at.is_(None)).values(updated_at=datetime.utcnow()))
+    db.session.commit()
 
-gravatar = Gravatar(app,
-                    size=100,
-                    rating='g',
-                    default='retro',
-                    force_default=False,
-                    force_lower=False,
-                    use_ssl=False,
-                    base_url=None)
+# Run once per deploy (Procfile release phase), never on import: every gunicorn worker imports this module
+@app.cli.command("sync-db")
+def sync_db():
+    db.create_all()
+    sync_schema()
+
+
+# CONTACT MAIL
+# One long-lived SMTP connection on a background thread, so /contact never waits on Gmail
+CONTACT_EMAIL = os.environ.get('CONTACT_EMAIL')
+CONTACT_PASS = os.environ.get('CONTACT_PASS')
+MY_EMAIL = os.environ.get('MY_EMAIL')
+mail_queue = queue.Queue()
+
+def connect_smtp():
+    connection = SMTP("smtp.gmail.com", 587, timeout=30)
+    connection.starttls()
+    connection.login(user=CONTACT_EMAIL, password=CONTACT_PASS)
+    return connection
+
+def build_contact_message(name, email, message):
+    msg = EmailMessage()
+    msg["Subject"] = "New message from the blog contact form"
+    msg["From"] = CONTACT_EMAIL
+    msg["To"] = MY_EMAIL
+    msg.set_content(f"By:{name}  {email}\n{message}")
+    return msg
+
+def mail_worker():
+    connection = None
+    while True:
+        name, email, message = mail_queue.get()
+        try:
+            msg = build_contact_message(name, email, message)
+            if connection is None:
+                connection = connect_smtp()
+                connection.send_message(msg)
+            else:
+                try:
+                    connection.send_message(msg)
+                except (SMTPException, OSError):
+                    # Gmail drops idle sessions (often with a 421 read back as the MAIL FROM reply),
+                    # so retry once on a fresh connection before giving up on the message
+                    connection.close()
+                    connection = connect_smtp()
+                    connection.send_message(msg)
+        except Exception:
+            # Any error escaping here would kill the thread and silently stop all contact mail
+            app.logger.exception("Could not send contact message")
+            connection = None
+        finally:
+            mail_queue.task_done()
+
+threading.Thread(target=mail_worker, daemon=True).start()
 
 
 
@@ -119,12 +305,13 @@ def register():
     form = RegisterForm()
     if request.method == 'POST' and form.validate_on_submit():
         email = form.email.data
-        existing_user = User.query.filter_by(email=email).first()
+        existing_user = db.session.scalar(db.select(db.exists().where(User.email == email)))
         if not existing_user:
             new_user = User(
                         name=form.name.data,
                         email=form.email.data,
-                        password=generate_password_hash(form.password.data,salt_length=8),
+                        email_md5=email_hash(form.email.data),
+                        password=run_hash(password_hasher.hash, form.password.data),
                     )
             db.session.add(new_user)
             db.session.commit()
@@ -143,7 +330,7 @@ def login():
     if form.validate_on_submit():
         email = form.email.data
         user = User.query.filter_by(email=email).first()
-        if user and check_password_hash(pwhash=user.password, password=form.password.data):
+        if user and verify_password(user, form.password.data):
             login_user(user)
             return redirect(url_for('get_all_posts'))
         else:
@@ -162,11 +349,24 @@ def logout():
 
 
 
+# Keyed on the same version as the ETag, so no worker can pair a new ETag with HTML rendered before the change
+@cache.memoize(timeout=300, unless=lambda: current_user.is_authenticated)
+def render_home(version):
+    # Fetched in batches of 50 while the template iterates; index.html loops over it once
+    posts = db.session.scalars(
+        db.select(BlogPost)
+        .options(defer(BlogPost.body), selectinload(BlogPost.author))
+        .order_by(BlogPost.date.desc(), BlogPost.id.desc())
+        .execution_options(yield_per=50)
+    )
+    return render_template("index.html", all_posts=posts)
+
+
 @app.route('/')
 def get_all_posts():
-    result = db.session.execute(db.select(BlogPost))
-    posts = result.scalars().all()
-    return render_template("index.html", all_posts=posts)
+    latest, count = db.session.execute(db.select(db.func.max(BlogPost.updated_at), db.func.count(BlogPost.id))).one()
+    version = f"{current_user.get_id()}-{count}-{latest}"
+    return conditional_response(version, lambda: render_home(version))
 
 
 
@@ -174,8 +374,15 @@ def get_all_posts():
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
     form = CommentForm()
-    requested_post = db.get_or_404(BlogPost, post_id)
-    comments = Comment.query.filter_by(post_id=post_id)
+    requested_post = db.first_or_404(
+        db.select(BlogPost).where(BlogPost.id == post_id).options(joinedload(BlogPost.author))
+    )
+    comments = db.session.scalars(
+        db.select(Comment)
+        .where(Comment.post_id == post_id)
+        .options(joinedload(Comment.comment_author))
+        .order_by(Comment.id)
+    ).all()
     
     if form.validate_on_submit():
         if current_user.is_authenticated:
@@ -192,7 +399,14 @@ def show_post(post_id):
             return redirect(url_for("login"))
     
         
-    return render_template("post.html", post=requested_post, form=form, post_comments=comments)
+    # The comment form's CSRF token expires, so roll the ETag over every half token lifetime
+    csrf_limit = app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    csrf_window = int(time.time() // (csrf_limit // 2)) if csrf_limit else 0
+    version = f"{current_user.get_id()}-{requested_post.id}-{len(comments)}-{requested_post.updated_at}-{csrf_window}"
+    return conditional_response(
+        version,
+        lambda: render_template("post.html", post=requested_post, form=form, post_comments=comments),
+    )
 
 
 
@@ -208,7 +422,7 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=date.today()
         )
         
         db.session.add(new_post)
@@ -264,15 +478,25 @@ def about():
 def contact():
     # Doesn't work yet because no email
     if request.method == 'POST':
-        connection = SMTP("smtp.gmail.com")
-        connection.starttls()
-        connection.login(user=os.environ.get('CONTACT_EMAIL'), password=os.environ.get('CONTACT_PASS'))
-        connection.sendmail(from_addr=os.environ.get('CONTACT_EMAIL'), to_addrs=os.environ.get('MY_EMAIL'), msg=f"By:{request.form.get('name')}  {request.form.get('email')}\n{request.form.get('message')}")
-        connection.close()
+        mail_queue.put((request.form.get('name'), request.form.get('email'), request.form.get('message')))
         return redirect(url_for('get_all_posts'))
     return render_template("contact.html")
 
 
 
+# WARM UP
+# Compile templates and build the form classes now, so the first visitor after a deploy doesn't pay for it
+for template in ("header.html", "footer.html", "index.html", "post.html", "login.html", "register.html",
+                 "make-post.html", "about.html", "contact.html"):
+    app.jinja_env.get_template(template)
+
+with app.test_request_context():
+    for form_class in (CreatePostForm, RegisterForm, LoginForm, CommentForm):
+        form_class(meta={'csrf': False})
+
+
 if __name__ == "__main__":
+    with app.app_context():
+        db.create_all()
+        sync_schema()
     app.run(debug=True, port=5002)
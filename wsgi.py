@@ -0,0 +1,5 @@
+# Patch blocking stdlib I/O (sockets, smtplib, threading) before the app is imported
+from gevent import monkey
+monkey.patch_all()
+
+from main import app